@@ -3,26 +3,49 @@
 from __future__ import annotations
 
 import argparse
+import hashlib
+import json
+import os
 import re
 import subprocess
 import sys
+from concurrent.futures import ProcessPoolExecutor
 from contextlib import contextmanager
 from dataclasses import dataclass, field
 from difflib import unified_diff
+from functools import lru_cache, partial
+from io import StringIO
 from pathlib import Path
-from typing import TYPE_CHECKING, Any, ClassVar
+from typing import TYPE_CHECKING, Any, ClassVar, Literal
 
+import docutils
 from docutils import io, nodes, writers
-from docutils.core import publish_doctree, publish_from_doctree
+from docutils.core import publish_doctree
 from docutils.parsers.rst import Directive, Parser, directives
 from docutils.parsers.rst.states import Body, Inliner
 from docutils.readers.standalone import Reader
 
 if TYPE_CHECKING:
-    from collections.abc import Generator
+    from collections.abc import Callable, Generator, Iterator
 
     from docutils.statemachine import StringList
 
+# splits the content of a text node into words
+_WS_SPLIT_RE = re.compile(r"[ \n]+")
+
+# words starting with these characters are attached to the previous word, without a space
+_PUNCT_PREFIX = (",", ".")
+
+# prebuilt newline strings for the common append(newlines=n) calls
+_NEWLINES = ("", "\n", "\n\n", "\n\n\n")
+
+# format_rst inserts a blank line between a line ending in ':' and a bullet list, so docutils sees the list
+_BULLET_FIXUP_RE = re.compile(r":\n(\s*[-*] )")
+_BULLET_UNFIX_RE = re.compile(r":\n\n(\s*[-*] )")
+
+# a directive that directly follows a line of text
+_DIRECTIVE_NL_RE = re.compile(r"([^\n])(\n[.][.] )")
+
 
 @dataclass
 class RstFormatterConfig:
@@ -42,6 +65,12 @@ class RstFormatterConfig:
     # newline after ':' in a bullet list, rst specifies that a newline is needed before the first item
     newline_bullet_list: bool = False
 
+    # sort the options of a directive alphabetically, otherwise the original order is kept
+    sort_directive_options: bool = True
+
+    # how to wrap paragraphs: fill every line as far as possible, or spread the words to get evenly filled lines
+    wrap_algorithm: Literal["greedy", "optimal"] = "greedy"
+
     # if a directive has a substring-match on the first entry, it is filtered through the external command
     filter_directives: list[tuple[str, list[str]]] = field(default_factory=list)
 
@@ -58,6 +87,12 @@ class RstFormatterConfig:
         parser.add_argument("--titles", nargs="+", default=["==", "=", "-", "^"], help="Title formatting characters")
         parser.add_argument("--newline-after-title", type=int, default=2, help="Add newline after major headings")
         parser.add_argument("--newline-bullet-list", action="store_true", help='Add newline after ":" in a bullet list')
+        parser.add_argument(
+            "--keep-option-order", action="store_true", help="Do not sort the options of a directive alphabetically"
+        )
+        parser.add_argument(
+            "--wrap", choices=["greedy", "optimal"], default="greedy", help="Line wrapping algorithm for paragraphs"
+        )
         parser.add_argument("--ruff", action="store_true", help="Filter directives containing 'python' through ruff")
         parser.add_argument("--print-parse-tree", action="store_true", help=argparse.SUPPRESS)
 
@@ -72,6 +107,8 @@ class RstFormatterConfig:
             config.title_order = args.titles
         config.newline_after_title = args.newline_after_title
         config.newline_bullet_list = args.newline_bullet_list
+        config.sort_directive_options = not args.keep_option_order
+        config.wrap_algorithm = args.wrap
         config.print_node_tree = args.print_parse_tree
         if args.ruff:
             config.filter_directives.append(("python", ["ruff", "format", "-"]))
@@ -134,63 +171,188 @@ class RstTranslator(nodes.NodeVisitor):
     def __init__(self, document: nodes.document, config: RstFormatterConfig) -> None:
         """Construct RstTranslator."""
         super().__init__(document)
-        self.output: list[str] = []  # the final output. Will be joined on return
+        self.output = StringIO()  # the final output
         self.config = config
 
+        # settings and methods used for every word or title, bound once instead of looked up on every use
+        self._write = self.output.write
+        self._max_line_length = config.max_line_length
+        # (overline char or None, underline char) per section depth
+        self._title_seps = tuple((sep[0] if len(sep) == 2 else None, sep[-1]) for sep in config.title_order)
+        self._newline_after_title = config.newline_after_title
+        self._wrap_paragraph = (
+            self._append_optimal_wrap if config.wrap_algorithm == "optimal" else self._append_word_wrap
+        )
+
+        # frozen snapshots of the node-type tables, for the per-node lookups in unknown_visit/unknown_departure
+        self._non_breakable_nodes = frozenset(self.non_breakable_nodes)
+        self._ignored_node_types = frozenset(self.ignored_nodes)
+
+        # bound visit_/depart_ methods per node class, see dispatch_visit and dispatch_departure
+        self._visit_methods: dict[type, Callable[[nodes.Node], None]] = {}
+        self._depart_methods: dict[type, Callable[[nodes.Node], None]] = {}
+
         # while inside something non-breakable we append to hold-space instead of output. When inside multiple
-        # non-breakable tags we add another entry.
-        self.hold_space: list[list[str]] = []  # inside something non-breakable
+        # non-breakable tags, the text of every level is appended to the same list, hold_space_starts records where
+        # each level starts.
+        self.hold_space: list[str] = []  # inside something non-breakable
+        self.hold_space_starts: list[int] = []
+
+        # inside a paragraph all words are collected first, and wrapped in one go when the paragraph ends
+        self.paragraph_words: list[str] = []
+
+        # append text to output (or the paragraph), unless inside a non-breakable element, then append to hold space.
+        # The method is swapped when entering and leaving paragraphs and non-breakable elements, instead of checking
+        # where we are on every call. _append_outside_hold_space is what to go back to when leaving the hold space.
+        self._append_outside_hold_space: Callable[..., None] = self._append_output
+        self.append: Callable[..., None] = self._append_output
         self.line_length: int = 0  # where is my cursor
+        self.pending_newlines = 0  # newlines are only written once more text follows
 
         self.indent_level = 0  # how many times have we entered a block
         self.indent = "  "  # how many spaces to add every time we enter a block
+        self.indent_str = ""  # self.indent repeated indent_level times
+        self._indents = [""]  # indent_str for every level seen so far
 
         self.section_depth = 0  # for the heading characters
 
         self.bullet_char: list[str] = []  # for bullet lists in bullet lists
 
         self.need_newline_before_paragraph_start = False
+        self.paragraph_ends_with_colon = False  # a directly following bullet list needs no blank line
+
+    def dispatch_visit(self, node: nodes.Node) -> None:
+        """Call the visit-method for this node, the method is looked up once per node class."""
+        node_type = type(node)
+        method = self._visit_methods.get(node_type)
+        if method is None:
+            method = getattr(self, "visit_" + node_type.__name__, self.unknown_visit)
+            self._visit_methods[node_type] = method
+        method(node)
+
+    def dispatch_departure(self, node: nodes.Node) -> None:
+        """Call the depart-method for this node, the method is looked up once per node class."""
+        node_type = type(node)
+        method = self._depart_methods.get(node_type)
+        if method is None:
+            method = getattr(self, "depart_" + node_type.__name__, self.unknown_departure)
+            self._depart_methods[node_type] = method
+        method(node)
 
     def _append_word_wrap(self, text: list[str]) -> None:
+        # this runs for every word in the document, so keep the cursor and all lookups in locals
+        write = self._write
+        max_line_length = self._max_line_length
+        line_length = self.line_length
         for word in text:
             if not word:
                 continue
-            if self.line_length + 1 + len(word) > self.config.max_line_length:
-                self.append(newlines=1)
-            if self.line_length == 0:
-                indent = self.indent * self.indent_level
-                self.line_length += len(indent) + len(word)
-                self.output.extend([indent, word])
+            word_length = len(word)
+            if line_length > 0 and line_length + 1 + word_length > max_line_length:
+                self.pending_newlines += 1
+                line_length = 0
+            if line_length == 0:
+                if self.pending_newlines:
+                    self._write_pending_newlines()
+                indent = self.indent_str
+                line_length = len(indent) + word_length
+                write(indent)
+                write(word)
             else:
-                self.line_length += 1 + len(word)
-                if not word.startswith(tuple(",.")):
-                    self.output.extend([" "])
-                self.output.extend([word])
-
-    def append(self, text: list[str] | None = None, *, newlines: int = 0) -> None:
-        """Append text to output, unless inside a non-breakable element, then append to hold space."""
-        if len(self.hold_space) == 0:
-            if text is not None:
-                self._append_word_wrap(text)
-            if newlines > 0:
-                self.output.append("\n" * newlines)
-                self.line_length = 0
-        else:
-            if newlines != 0:
-                raise NotImplementedError  # not supported, not sure if we want to add newlines to the hold-space
-            if text:
-                self.hold_space[-1].extend(text)
+                line_length += 1 + word_length
+                if not word.startswith(_PUNCT_PREFIX):
+                    write(" ")
+                write(word)
+        self.line_length = line_length
+
+    def _append_optimal_wrap(self, text: list[str]) -> None:
+        words = [word for word in text if word]
+        if not words:
+            return
+        write = self._write
+        indent = self.indent_str
+        line_length = self.line_length
+        start = 0
+        for end in optimal_line_breaks(words, line_length, len(indent), self._max_line_length):
+            for word in words[start:end]:
+                if line_length == 0:
+                    if self.pending_newlines:
+                        self._write_pending_newlines()
+                    write(indent)
+                    write(word)
+                    line_length = len(indent) + len(word)
+                elif word.startswith(_PUNCT_PREFIX):
+                    write(word)
+                    line_length += len(word)
+                else:
+                    write(" ")
+                    write(word)
+                    line_length += 1 + len(word)
+            if end < len(words):
+                self.pending_newlines += 1
+                line_length = 0
+            start = end
+        self.line_length = line_length
+
+    def _push_indent(self) -> None:
+        self.indent_level += 1
+        if self.indent_level == len(self._indents):
+            self._indents.append(self._indents[-1] + self.indent)
+        self.indent_str = self._indents[self.indent_level]
+
+    def _pop_indent(self) -> None:
+        self.indent_level -= 1
+        self.indent_str = self._indents[self.indent_level]
+
+    def _append_output(self, text: list[str] | None = None, *, newlines: int = 0) -> None:
+        if text is not None:
+            self._append_word_wrap(text)
+        if newlines > 0:
+            self.pending_newlines += newlines
+            self.line_length = 0
+
+    def _write_pending_newlines(self) -> None:
+        # newlines before the first text are dropped, newlines after the last text are never written
+        if self.output.tell() > 0:
+            newlines = self.pending_newlines
+            self._write(_NEWLINES[newlines] if newlines < len(_NEWLINES) else "\n" * newlines)
+        self.pending_newlines = 0
+
+    def _append_paragraph(self, text: list[str] | None = None, *, newlines: int = 0) -> None:
+        if text is not None:
+            self.paragraph_words.extend(text)
+        if newlines > 0:
+            self._flush_paragraph()
+            self._append_output(newlines=newlines)
+
+    def _flush_paragraph(self) -> None:
+        if self.paragraph_words:
+            self._wrap_paragraph(self.paragraph_words)
+            self.paragraph_words.clear()
+
+    def _append_hold_space(self, text: list[str] | None = None, *, newlines: int = 0) -> None:
+        if newlines != 0:
+            raise NotImplementedError  # not supported, not sure if we want to add newlines to the hold-space
+        if text:
+            self.hold_space.extend(text)
 
     def enter_nonbreakable_element(self) -> None:
         """Add all text to hold-space instead of output."""
-        self.hold_space.append([])
+        self.hold_space_starts.append(len(self.hold_space))
+        self.append = self._append_hold_space
 
     def exit_nonbreakable_element(self, join_char: str = " ") -> str:
         """Return outer level of hold space, joined on join_char."""
-        return join_char.join(self.hold_space.pop())
+        start = self.hold_space_starts.pop()
+        text = join_char.join(self.hold_space[start:])
+        del self.hold_space[start:]
+        if len(self.hold_space_starts) == 0:
+            self.append = self._append_outside_hold_space
+        return text
 
     def append_possible_newline(self) -> None:
         """Emit a newline if the previous node requested it."""
+        self.paragraph_ends_with_colon = False
         if self.need_newline_before_paragraph_start:
             self.append(newlines=1)
             self.need_newline_before_paragraph_start = False
@@ -226,33 +388,58 @@ class RstTranslator(nodes.NodeVisitor):
 
     def depart_title(self, _node: nodes.title) -> None:
         title_text = self.exit_nonbreakable_element()
-        try:
-            sep_chars = self.config.title_order[self.section_depth - 1]
-        except IndexError as err:
-            raise RuntimeError("Not enough title characters defined in 'title_order'") from err
-        if len(sep_chars) == 2:
-            self.append([sep_chars[0] * len(title_text)], newlines=1)
-        self.append([title_text], newlines=1)
-        self.append([sep_chars[-1] * len(title_text)], newlines=1)
-        if self.section_depth <= self.config.newline_after_title:
+        if self.section_depth > len(self._title_seps):
+            raise RuntimeError("Not enough title characters defined in 'title_order'")
+        overline_char, underline_char = self._title_seps[self.section_depth - 1]
+        # titles are never wrapped, so write them out directly
+        self._write_pending_newlines()
+        underline = underline_char * len(title_text)
+        if overline_char is not None:
+            self._write(f"{overline_char * len(title_text)}\n{title_text}\n{underline}")
+        else:
+            self._write(f"{title_text}\n{underline}")
+        self.pending_newlines = 1
+        self.line_length = 0
+        if self.section_depth <= self._newline_after_title:
             self.need_newline_before_paragraph_start = True
 
     def visit_paragraph(self, _node: nodes.paragraph) -> None:
-        self.append_possible_newline()
+        # append_possible_newline(), inlined as this runs for every paragraph
+        self.paragraph_ends_with_colon = False
+        if self.need_newline_before_paragraph_start:
+            self.append(newlines=1)
+            self.need_newline_before_paragraph_start = False
+        self.append = self._append_outside_hold_space = self._append_paragraph
 
-    def depart_paragraph(self, _node: nodes.paragraph) -> None:
+    def depart_paragraph(self, node: nodes.paragraph) -> None:
+        self._flush_paragraph()
+        self.append = self._append_outside_hold_space = self._append_output
         self.append(newlines=1)  # end the current sentence
         self.need_newline_before_paragraph_start = True
+        self.paragraph_ends_with_colon = (
+            len(node.children) > 0 and isinstance(node[-1], nodes.Text) and node[-1].rstrip().endswith(":")
+        )
 
     def visit_Text(self, node: nodes.Text) -> None:
-        text = node.astext()
-        self.append(re.split(r"[ \n]+", text))
+        # a Text node is a str, astext() is only needed to remove the nulls that mark backslash-escapes
+        text = node.astext() if "\x00" in node else node
+        # no empty words, the hold-space would join them into double spaces
+        if text.isascii():
+            self.append(text.split())
+        else:
+            # str.split() would also break on non-breaking spaces
+            self.append([word for word in _WS_SPLIT_RE.split(text) if word])
 
     def depart_Text(self, _node: nodes.Text) -> None:
         pass
 
     def visit_bullet_list(self, node: nodes.bullet_list) -> None:
-        if len(self.bullet_char) > 0 or self.need_newline_before_paragraph_start:
+        # a list directly following a line ending in ':' is kept together with that line
+        keep_together = (
+            not self.config.newline_bullet_list and self.paragraph_ends_with_colon and node["bullet"] in "-*"
+        )
+        self.paragraph_ends_with_colon = False
+        if not keep_together and (len(self.bullet_char) > 0 or self.need_newline_before_paragraph_start):
             self.append(newlines=1)
         self.bullet_char.append(node["bullet"])
 
@@ -261,11 +448,12 @@ class RstTranslator(nodes.NodeVisitor):
 
     def visit_list_item(self, _node: nodes.list_item) -> None:
         self.append([self.bullet_char[-1] + self.indent[1:-1]])
-        self.indent_level += 1
+        self._push_indent()
         self.need_newline_before_paragraph_start = False
+        self.paragraph_ends_with_colon = False  # the previous item's last line does not introduce this item
 
     def depart_list_item(self, _node: nodes.list_item) -> None:
-        self.indent_level -= 1
+        self._pop_indent()
 
     def visit_citation(self, _node: nodes.citation) -> None:
         self.append_possible_newline()
@@ -292,8 +480,9 @@ class RstTranslator(nodes.NodeVisitor):
         if self.line_length != 0:
             raise RuntimeError("Directive found while indented.")
         self.append([f".. {node.name}::", *node.arguments], newlines=1)
-        self.indent_level += 1
-        for key, value in sorted(node.options.items()):
+        self._push_indent()
+        options = sorted(node.options.items()) if self.config.sort_directive_options else node.options.items()
+        for key, value in options:
             self.append([f":{key}:", value], newlines=1)
 
         if node.options and node.content:
@@ -302,40 +491,149 @@ class RstTranslator(nodes.NodeVisitor):
         if node.content:
             content = "\n".join(node.content)
             content = filter_directive_content(node.name, content, self.config)
-            for line in content.split("\n"):
-                self.append([line], newlines=1)
+            if not self.config.newline_bullet_list:
+                content = _BULLET_UNFIX_RE.sub(r":\n\1", content)
+            # content is never wrapped, so write it out directly; empty lines get no indent
+            indent = self.indent_str
+            self._write_pending_newlines()
+            self._write("\n".join(f"{indent}{line}" if line else "" for line in content.split("\n")))
+            self.pending_newlines = 1
+            self.line_length = 0
 
     def depart_DirectivePlaceholder(self, _node: DirectivePlaceholder) -> None:
-        self.indent_level -= 1
+        self._pop_indent()
         self.need_newline_before_paragraph_start = True
 
     def unknown_visit(self, node: nodes.Node) -> None:
         """Reached a node that has no specific visitor."""
-        if isinstance(node, self.ignored_nodes):
+        node_type = type(node)
+        if node_type in self._non_breakable_nodes:
+            self.enter_nonbreakable_element()
             return
 
-        if type(node) in self.non_breakable_nodes:
-            self.enter_nonbreakable_element()
+        if node_type in self._ignored_node_types:
             return
 
         raise RuntimeError(f"Unknown visit {type(node)}")
 
     def unknown_departure(self, node: nodes.Node) -> None:
         """Leaving a node that has no specific visitor."""
-        if isinstance(node, self.ignored_nodes):
-            return
-
-        if type(node) in self.non_breakable_nodes and isinstance(node, nodes.Element):
+        node_type = type(node)
+        if node_type in self._non_breakable_nodes and isinstance(node, nodes.Element):
             self.exit_nonbreakable_element()
             self.append([node.rawsource])
             return
 
+        if node_type in self._ignored_node_types:
+            return
+
         raise RuntimeError(f"Unknown departure {type(node)}")
 
 
+def optimal_line_breaks(words: list[str], line_start: int, indent_length: int, max_line_length: int) -> list[int]:
+    """
+    Return where to break the words into lines, as the index after the last word of every line.
+
+    Minimizes the sum of the squared space left at the end of every line but the last (Knuth-Plass, without the
+    hyphenation). The first line continues at line_start, if that is not 0. Punctuation stays attached to the previous
+    word, and a word that does not fit on a line by itself gets a line of its own.
+    """
+    n = len(words)
+    costs = [0.0] * (n + 1)
+    line_ends = [n] * (n + 1)
+    for first in range(n - 1, -1, -1):
+        costs[first] = float("inf")
+        continued = first == 0 and line_start > 0
+        line_length = line_start if continued else indent_length - 1  # -1 for the space the first word doesn't get
+        for last in range(first, n):
+            word = words[last]
+            attached = (continued or last > first) and word.startswith(_PUNCT_PREFIX)
+            line_length += len(word) if attached else 1 + len(word)
+            if last + 1 < n and words[last + 1].startswith(_PUNCT_PREFIX):
+                continue  # no break before punctuation
+            overflow = line_length > max_line_length
+            if overflow and costs[first] != float("inf"):
+                break  # a shorter line was possible, so this one may not overflow
+            line_cost = 0 if last + 1 == n or overflow else (max_line_length - line_length) ** 2
+            if line_cost + costs[last + 1] < costs[first]:
+                costs[first] = line_cost + costs[last + 1]
+                line_ends[first] = last + 1
+            if overflow:
+                break
+
+    breaks = []
+    end = 0
+    while end < n:
+        end = line_ends[end]
+        breaks.append(end)
+    return breaks
+
+
+def walkabout(root: nodes.Node, visitor: nodes.NodeVisitor) -> None:
+    """
+    Traverse the tree like docutils' Node.walkabout, but with an explicit stack instead of recursion.
+
+    The visitor can control the traversal with the same exceptions (SkipNode, SkipDeparture, SkipChildren,
+    SkipSiblings and StopTraversal). Like in docutils, SkipSiblings from the root and StopTraversal from its departure
+    are raised to the caller.
+    """
+    # every entry is a visited node, an iterator over its remaining children, and whether to depart it
+    stack: list[tuple[nodes.Node, Iterator[nodes.Node], bool]] = []
+    stopped = _walkabout_enter(root, visitor, stack)
+    while stack:
+        node, children, call_depart = stack[-1]
+        child = None if stopped else next(children, None)
+        if child is not None:
+            stopped = _walkabout_enter(child, visitor, stack)
+            continue
+
+        stack.pop()
+        if call_depart:
+            try:
+                visitor.dispatch_departure(node)
+            except nodes.SkipSiblings:
+                if not stack:
+                    raise
+                _walkabout_skip_siblings(stack)
+            except nodes.StopTraversal:
+                if not stack:
+                    raise
+                stopped = True
+
+
+def _walkabout_enter(node: nodes.Node, visitor: nodes.NodeVisitor, stack: list) -> bool:
+    """Visit node and push it on the walkabout stack. Return True when the traversal must stop."""
+    try:
+        visitor.dispatch_visit(node)
+    except nodes.SkipNode:
+        pass
+    except nodes.SkipSiblings:
+        if not stack:
+            raise
+        _walkabout_skip_siblings(stack)
+    except nodes.SkipDeparture:
+        stack.append((node, iter(node.children[:]), False))
+    except nodes.SkipChildren:
+        stack.append((node, iter(()), True))
+    except nodes.StopTraversal:
+        stack.append((node, iter(()), True))
+        return True
+    else:
+        stack.append((node, iter(node.children[:]), True))
+    return False
+
+
+def _walkabout_skip_siblings(stack: list) -> None:
+    """Drop the remaining children of the node on top of the walkabout stack."""
+    parent, _children, call_depart = stack[-1]
+    stack[-1] = (parent, iter(()), call_depart)
+
+
 class RstFormattingWriter(writers.Writer):
     """A docutils Writer that emits rst."""
 
+    output: str  # set by translate()
+
     def __init__(self, config: RstFormatterConfig) -> None:
         """Construct an RstFormattingWriter."""
         super().__init__()
@@ -344,8 +642,8 @@ class RstFormattingWriter(writers.Writer):
     def translate(self) -> None:
         """Do the work."""
         self.visitor = visitor = RstTranslator(self.document, config=self.config)
-        self.document.walkabout(visitor)
-        self.output = "".join(visitor.output)
+        walkabout(self.document, visitor)
+        self.output = visitor.output.getvalue()
 
 
 def forgiving_parse_directive_block(
@@ -354,24 +652,31 @@ def forgiving_parse_directive_block(
     """Parse a directive without accessing the directive."""
     # indented[0] is the list of arguments after the directive name
     arguments: list[str] = indented[0].strip().split()
-    indented.trim_start()  # skip arguments
 
+    # find the options and the content by index, and trim 'indented' once at the end. Every trim copies the list.
     options: dict[str, str] = {}
     option_regex = self.patterns["field_marker"]
-    while indented:
-        option_match = option_regex.match(indented[0])
+    line_count = len(indented)
+    start = 1  # skip arguments
+    while start < line_count:
+        option_match = option_regex.match(indented[start])
         if not option_match:
             break
         key = option_match.group()  # including ':'
-        value = indented[0][len(key) :]
+        value = indented[start][len(key) :]
         options[key[1:-2]] = value
-        indented.trim_start()
+        start += 1
 
-    while indented and len(indented[-1].strip()) == 0:
-        indented.trim_end()
+    end = line_count
+    while end > start and len(indented[end - 1].strip()) == 0:
+        end -= 1
 
-    if indented and len(indented[0].strip()) == 0:
-        indented.trim_start()  # blank line between options and content
+    if start < end and len(indented[start].strip()) == 0:
+        start += 1  # blank line between options and content
+
+    if end < line_count:
+        indented.trim_end(line_count - end)
+    indented.trim_start(start)
 
     return arguments, options, indented, indented.parent_offset
 
@@ -386,11 +691,13 @@ def monkeypatch_directives_handler() -> Generator[None, Any, None]:
     - The directive parse function with our own, so we don't need to know whether or not the directive has options.
     """
 
-    class MonkeyPatchedDirectiveHandler:
-        def __contains__(self, key: str) -> bool:
-            return True
+    class MonkeyPatchedDirectiveHandler(dict[str, type[Directive]]):
+        def __contains__(self, key: object) -> bool:
+            return True  # docutils would try to import the real directive otherwise
 
-        def __getitem__(self, item: str) -> type[Directive]:
+        def __missing__(self, key: str) -> type[Directive]:
+            # store it, so the next lookup of the same directive is a plain dict hit
+            self[key] = DirectivePlaceholder
             return DirectivePlaceholder
 
     old_directive_handler = directives._directives  # noqa: SLF001
@@ -411,10 +718,15 @@ def fix_heading_line_length(input_rst: str, config: RstFormatterConfig) -> str:
     Replace every line consisting 3-or-more heading-characters with exactly 4 heading characters.
     This will make docutils' rst parser construct the correct node tree, so we can emit the correct output later.
     """
-    chars = "".join(set("".join(config.title_order))).replace("^", "\\^").replace("-", "\\-")
+    return _heading_regex(tuple(config.title_order)).sub(r"\1\1\1\1", input_rst)
+
+
+@lru_cache(maxsize=16)
+def _heading_regex(title_order: tuple[str, ...]) -> re.Pattern:
+    """Compile the regex matching a heading line for the given title characters."""
+    chars = re.escape("".join(dict.fromkeys("".join(title_order))))  # de-duplicated, in a stable order
     regex_str = r"^([CHARS]){3,}$".replace("CHARS", chars)
-    compiled_regex = re.compile(regex_str, flags=re.MULTILINE)
-    return compiled_regex.sub(r"\1\1\1\1", input_rst)
+    return re.compile(regex_str, flags=re.MULTILINE)
 
 
 def filter_directive_content(directive_name: str, content: str, config: RstFormatterConfig) -> str:
@@ -431,11 +743,13 @@ def format_rst(input_rst: str, config: RstFormatterConfig | None = None) -> str:
     if config is None:
         config = RstFormatterConfig()
 
-    if not config.newline_bullet_list:
-        input_rst = re.sub(r":\n(\s*[-*] )", r":\n\n\1", input_rst)
+    # the substring checks are much cheaper than a regex scan, and most documents only need one of the fixes
+    if not config.newline_bullet_list and ":\n" in input_rst:
+        input_rst = _BULLET_FIXUP_RE.sub(r":\n\n\1", input_rst)
 
     # fix case of forgetting a newline before a directive
-    input_rst = re.sub(r"([^\n])(\n[.][.] )", r"\1\n\2", input_rst)
+    if "\n.. " in input_rst:
+        input_rst = _DIRECTIVE_NL_RE.sub(r"\1\n\2", input_rst)
 
     input_rst = fix_heading_line_length(input_rst, config)
 
@@ -446,7 +760,6 @@ def format_rst(input_rst: str, config: RstFormatterConfig | None = None) -> str:
         "report_level": 5,
         "halt_level": 5,
         # "warning_stream": sys.stderr,
-        "output_encoding": "unicode",
     }
 
     with monkeypatch_directives_handler():
@@ -458,57 +771,167 @@ def format_rst(input_rst: str, config: RstFormatterConfig | None = None) -> str:
             settings_overrides=settings_overrides,
         )
 
-        if config.print_node_tree:
-            print(doctree.pformat())
+    if config.print_node_tree:
+        print(doctree.pformat())
+
+    # run the writer directly on the doctree instead of through a second docutils publisher, only the writer's
+    # transforms (that e.g. filter system messages) need to be applied
+    writer = RstFormattingWriter(config)
+    doctree.transformer.add_transforms(writer.get_transforms())
+    doctree.transformer.apply_transforms()
+    writer.document = doctree
+    writer.translate()
+    return writer.output
+
+
+def formatted_cache_path() -> Path:
+    """Return the location of the cache of documents that are known to need no changes."""
+    cache_home = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(cache_home) / "rst_formatter" / "formatted.json"
+
+
+def load_formatted_cache(path: Path) -> set[str]:
+    """Read the document hashes from the cache, an unreadable cache is treated as empty."""
+    try:
+        hashes = json.loads(path.read_text())
+    except (OSError, ValueError):
+        return set()
+    if not isinstance(hashes, list):
+        return set()
+    return {entry for entry in hashes if isinstance(entry, str)}
+
+
+def save_formatted_cache(path: Path, cache: set[str], new_hashes: set[str]) -> None:
+    """Add the new document hashes to the cache, the file is only written if any of them is not in it yet."""
+    if new_hashes <= cache:
+        return
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps(sorted(cache | new_hashes)))
 
-        writer = RstFormattingWriter(config)
-        out = publish_from_doctree(
-            doctree,
-            writer=writer,
-            writer_name="rst_formatting_writer",
-            settings_overrides=settings_overrides,
-        )
 
-    if not config.newline_bullet_list:
-        out = re.sub(r":\n\n(\s*[-*] )", r":\n\1", out)
-    return out.lstrip("\n").rstrip("\n")
+def formatted_hash(content: str, config: RstFormatterConfig) -> str:
+    """
+    Hash a document for the formatted-cache.
+
+    The config, this source file and the docutils version are part of the hash, so changing any of them invalidates
+    the cache. The external commands of filter_directives are not, so main doesn't use the cache with those.
+    """
+    digest = hashlib.sha256(_source_digest())
+    digest.update(docutils.__version__.encode())
+    digest.update(repr(config).encode())
+    digest.update(content.encode())
+    return digest.hexdigest()
+
+
+@lru_cache(maxsize=1)
+def _source_digest() -> bytes:
+    return hashlib.sha256(Path(__file__).read_bytes()).digest()
+
+
+def format_file(
+    rst_file: Path, content: str, config: RstFormatterConfig, *, check: bool, diff: bool
+) -> tuple[int, str]:
+    """
+    Format a single file for the command line tool.
+
+    content is the current content of rst_file. Return 0 if the file needs no changes and 1 otherwise, together with
+    the message describing what was done. A file that cannot be formatted is reported as an error, so the other files
+    of the run are still processed.
+    """
+    try:
+        out = format_rst(content, config)
+
+        if content == out:
+            return 0, "Nothing changed"
+
+        if diff:
+            return 1, "\n".join(unified_diff(content.splitlines(), out.splitlines(), lineterm=""))
+
+        if not check:
+            rst_file.write_text(out)
+            return 1, f"Writing changes to '{rst_file}'"
+    except Exception as err:  # noqa: BLE001
+        return 1, f"error: {err}"
+
+    return 1, "File needs changes (but file left unchanged)"
+
+
+def map_files(
+    process: Callable[[Path, str], tuple[int, str]], rst_files: list[Path], contents: list[str], jobs: int
+) -> list[tuple[int, str]]:
+    """Run process on every file and its content, in up to jobs processes."""
+    # every file is parsed independently, so with multiple files spread them over multiple processes
+    jobs = min(jobs, len(rst_files))
+    if jobs > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            chunksize = max(1, len(rst_files) // (4 * jobs))
+            return list(executor.map(process, rst_files, contents, chunksize=chunksize))
+    return list(map(process, rst_files, contents))
 
 
 def main(arguments: list[str] | None = None) -> int:
     """Entrypoint."""
-    parser = argparse.ArgumentParser(description="Tool for formatting an rst file")
-    parser.add_argument("input_file", type=Path, help="Input file to be processed")
+    parser = argparse.ArgumentParser(description="Tool for formatting rst files")
+    parser.add_argument("input_files", nargs="+", type=Path, help="Input files to be processed")
     parser.add_argument("--check", "-c", action="store_true", help="Return 0 if no changes are needed")
     parser.add_argument("--diff", "-d", action="store_true", help="Perform a diff operation")
     parser.add_argument("--silent", "-s", action="store_true", help="Run in silent mode")
+    parser.add_argument(
+        "--cache",
+        action="store_true",
+        help="Skip files that were already found to need no changes (with this config), ignored with --ruff",
+    )
+    parser.add_argument(
+        "--jobs", "-j", type=int, default=os.cpu_count() or 1, help="Number of files to format in parallel"
+    )
     RstFormatterConfig.prepare_argparse(parser)
     args = parser.parse_args(arguments if arguments is not None else sys.argv[1:])
     config = RstFormatterConfig.parse_argparse(args)
 
-    rst_file = args.input_file
-    content = rst_file.read_text()
-    out = format_rst(content, config)
-
     def print_unless_silent(arg: str) -> None:
         if not args.silent:
             print(arg)
 
-    if content == out:
-        print_unless_silent("Nothing changed")
-        return 0
+    # a file given twice must be formatted once, not by two workers at the same time
+    input_files: list[Path] = list(dict.fromkeys(args.input_files))
+
+    # the output of external filter commands can change without anything in the hash changing
+    use_cache = args.cache and not config.filter_directives
+    cache: set[str] = set()
+    if use_cache:
+        # only look up the cache location when asked for, that needs a home directory
+        cache_path = formatted_cache_path()
+        cache = load_formatted_cache(cache_path)
+    hashes: dict[Path, str] = {}
+    results: dict[Path, tuple[int, str]] = {}
+    to_format: list[Path] = []
+    contents: list[str] = []
+    for rst_file in input_files:
+        try:
+            content = rst_file.read_text()
+        except OSError as err:
+            results[rst_file] = (1, f"error: {err}")
+            continue
+        if use_cache:
+            hashes[rst_file] = formatted_hash(content, config)
+            if hashes[rst_file] in cache:
+                results[rst_file] = (0, "Nothing changed")
+                continue
+        to_format.append(rst_file)
+        contents.append(content)
 
-    if args.diff:
-        diff = list(unified_diff(content.splitlines(), out.splitlines(), lineterm=""))
-        print_unless_silent("\n".join(diff))
-        return 1
+    process = partial(format_file, config=config, check=args.check, diff=args.diff)
+    results.update(zip(to_format, map_files(process, to_format, contents, args.jobs), strict=True))
 
-    if not args.check:
-        print_unless_silent(f"Writing changes to '{rst_file}'")
-        rst_file.write_text(out)
-    else:
-        print_unless_silent("File needs changes (but file left unchanged)")
+    for rst_file in input_files:
+        _returncode, message = results[rst_file]
+        print_unless_silent(message if len(input_files) == 1 else f"{rst_file}: {message}")
+
+    if use_cache:
+        unchanged = {hashes[rst_file] for rst_file, (returncode, _message) in results.items() if returncode == 0}
+        save_formatted_cache(cache_path, cache, unchanged)
 
-    return 1
+    return max(returncode for returncode, _message in results.values())
 
 
 if __name__ == "__main__":
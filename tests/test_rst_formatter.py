@@ -2,11 +2,23 @@
 
 import argparse
 import re
-import tempfile
+from collections.abc import Callable
 from difflib import unified_diff
-
-import pytest  # noqa: F401
-from rst_formatter import RstFormatterConfig, fix_heading_line_length, format_rst, main
+from functools import partial
+from pathlib import Path
+
+import pytest
+import rst_formatter
+from docutils import nodes
+from docutils.utils import new_document
+from rst_formatter import (
+    RstFormatterConfig,
+    fix_heading_line_length,
+    format_rst,
+    formatted_cache_path,
+    main,
+    walkabout,
+)
 
 
 def print_unified_diff(left: str, right: str) -> None:
@@ -17,10 +29,9 @@ def print_unified_diff(left: str, right: str) -> None:
 
 def print_with_line_numbers(name: str, content: str) -> None:
     """Test-function that prints a block of code with line numbers prepended."""
-    print(f"content of {name}:")
-    for idx, line in enumerate(content.split("\n")):
-        print(f"{idx+1:3}: '{line}'")
-    print()
+    # split("\n") instead of splitlines(), a trailing newline must show up as an empty last line
+    numbered = "".join(f"{idx:3}: '{line}'\n" for idx, line in enumerate(content.split("\n"), 1))
+    print(f"content of {name}:\n{numbered}")
 
 
 def test_simple_text() -> None:
@@ -31,7 +42,21 @@ def test_simple_text() -> None:
     assert actual_text == input_text
 
 
-def test_fix_multiline_heading() -> None:
+def test_non_ascii_text() -> None:
+    """Non-ascii text is split on spaces and newlines only, a non-breaking space is kept."""
+    input_text = "\u00e9\u00e9n  twee\u00a0drie\nvier"
+    actual_text = format_rst(input_text)
+    assert actual_text == "\u00e9\u00e9n twee\u00a0drie vier"
+
+
+def test_title_inline_markup() -> None:
+    """Test words around inline markup in a title are separated by one space, for ascii and non-ascii text."""
+    assert format_rst("a *b* c\n=====") == "=======\na *b* c\n======="
+    assert format_rst("\u00e9 *b* c\n=====") == "=======\n\u00e9 *b* c\n======="
+
+
+@pytest.mark.parametrize("test_char", ["-", "=", "^"])
+def test_fix_multiline_heading(test_char: str) -> None:
     """Test the regular expression that will fix the title line length to 4."""
     input_text = """
 ---
@@ -47,11 +72,11 @@ My Title
 some text.
 """.strip()
 
-    for test_char in ("-", "=", "^"):
-        inp = input_text.replace("-", test_char)
-        exp = expected_output.replace("-", test_char)
-        act = fix_heading_line_length(inp, config=RstFormatterConfig())
-        assert exp == act
+    table = str.maketrans("-", test_char)
+    inp = input_text.translate(table)
+    exp = expected_output.translate(table)
+    act = fix_heading_line_length(inp, config=RstFormatterConfig())
+    assert exp == act
 
 
 def test_consecutive_headings() -> None:
@@ -84,9 +109,16 @@ Heading4
     assert actual_output == expected_output
 
 
-def test_rst_multiline_title() -> None:
+@pytest.mark.parametrize(
+    ("newline_after_title", "separator"),
+    [
+        (2, "\n\n"),
+        (-1, "\n"),
+    ],
+)
+def test_rst_multiline_title(newline_after_title: int, separator: str) -> None:
     """Test above-and-below titles are correctly replaced according to the config."""
-    config = RstFormatterConfig()
+    config = RstFormatterConfig(newline_after_title=newline_after_title)
     input_text = """
 ---
 My Title
@@ -94,28 +126,35 @@ My Title
 some text.
 """.strip()
 
-    expected_output1 = """
-========
-My Title
-========
+    expected_output = f"========\nMy Title\n========{separator}some text."
 
-some text.
-""".strip()
+    actual_output = format_rst(input_text, config=config)
+    assert actual_output == expected_output
 
-    actual_output1 = format_rst(input_text, config=config)
-    assert actual_output1 == expected_output1
 
-    config.newline_after_title = -1
+def test_long_title() -> None:
+    """Test titles longer than the maximum line length are not wrapped."""
+    config = RstFormatterConfig(max_line_length=20, title_order=["=="])
+    input_text = """
+A title that is longer than twenty characters
+===
+""".strip()
 
-    expected_output2 = """
-========
-My Title
-========
-some text.
+    expected_output = """
+=============================================
+A title that is longer than twenty characters
+=============================================
 """.strip()
 
-    actual_output2 = format_rst(input_text, config=config)
-    assert actual_output2 == expected_output2
+    actual_output = format_rst(input_text, config=config)
+    assert actual_output == expected_output
+
+
+def test_title_order_underline_only() -> None:
+    """Only a two-character title_order entry gets a line above the title, longer entries are underline-only."""
+    config = RstFormatterConfig(title_order=["###"])
+    actual_output = format_rst("Title\n=====", config=config)
+    assert actual_output == "Title\n#####"
 
 
 def test_simple_bullet_list() -> None:
@@ -178,6 +217,13 @@ regular text
     assert actual_output1 == expected_output1
 
 
+def test_bullet_list_after_colon_item() -> None:
+    """Test a ':' at the end of a list item does not change the layout of a list in the next item."""
+    assert format_rst("- foo\n- - x\n  - y") == "- foo\n-\n  - x\n  - y"
+    assert format_rst("- foo:\n- - x\n  - y") == "- foo:\n-\n  - x\n  - y"
+    assert format_rst("- foo:\n\n  - x\n  - y") == "- foo:\n  - x\n  - y"
+
+
 def test_inline_markup() -> None:
     """Check the formatting of special nodes is preserved."""
     input_text = """
@@ -228,6 +274,32 @@ Remainder
     assert actual_text == input_text
 
 
+def test_directive_option_order() -> None:
+    """Test directive options are sorted, unless configured otherwise."""
+    input_text = """
+.. csv-table:: tablename
+  :widths: 30, 100
+  :header: "header 1", "header 2"
+
+  col1, col2
+    """.strip()
+
+    expected_text = """
+.. csv-table:: tablename
+  :header: "header 1", "header 2"
+  :widths: 30, 100
+
+  col1, col2
+    """.strip()
+
+    actual_text = format_rst(input_text)
+    assert actual_text == expected_text
+
+    config = RstFormatterConfig(sort_directive_options=False)
+    actual_text = format_rst(input_text, config)
+    assert actual_text == input_text
+
+
 def test_directives_short() -> None:
     """Test the most short syntax for a directive."""
     input_text = """
@@ -248,6 +320,21 @@ Remainder
     assert actual_text == expected_text
 
 
+def test_directive_long_content_line() -> None:
+    """Directive content is written as-is, also when a line is longer than the maximum line length."""
+    long_line = "x = " + " + ".join(["value"] * 30)
+    input_text = f"""
+.. code::
+  {long_line}
+
+  y = x
+    """.strip()
+
+    actual_text = format_rst(input_text)
+    print_unified_diff(actual_text, input_text)
+    assert actual_text == input_text
+
+
 def test_reference() -> None:
     """Test many different reference formats."""
     input_text = """
@@ -292,9 +379,50 @@ def test_line_wrap() -> None:
     config = RstFormatterConfig(max_line_length=40)
     input_text = unbreakable * 50
     actual_text = format_rst(input_text, config)
-    lines = actual_text.split("\n")
-    assert all(len(line) < config.max_line_length for line in lines)
-    assert all(len(line) > config.max_line_length - len(unbreakable) for line in lines[:-1])
+    line_lengths = list(map(len, actual_text.split("\n")))
+    assert max(line_lengths) < config.max_line_length
+    assert min(line_lengths[:-1]) > config.max_line_length - len(unbreakable)
+
+    # a word longer than the line at the start of a line does not get an extra blank line before it
+    long_word = "b" * 50
+    input_text = f"a\n\n{long_word} c"
+    actual_text = format_rst(input_text, config)
+    assert actual_text == f"a\n\n{long_word}\nc"
+
+
+def test_multiple_no_line_break_regexes() -> None:
+    """Test text matching any of the no-line-break patterns is kept on one line."""
+    config = RstFormatterConfig(
+        max_line_length=10, no_line_break_regexes=[re.compile(r"~[^~]*~"), re.compile(r"@[^@]*@")]
+    )
+    input_text = "~a b c d e~ @f g h i j@ ~k l m n o~"
+    actual_text = format_rst(input_text, config)
+    assert actual_text == "~a b c d e~\n@f g h i j@\n~k l m n o~"
+
+    # the patterns are tried in order, so an earlier pattern wins over an overlapping match of a later one
+    config.max_line_length = 8
+    actual_text = format_rst("@a ~b@ c d e~", config)
+    assert actual_text == "@a\n~b@ c d e~"
+
+    # patterns with inline flags
+    config = RstFormatterConfig(max_line_length=4, no_line_break_regexes=[re.compile("(?i)a b"), re.compile("(?i)c d")])
+    actual_text = format_rst("A B C D", config)
+    assert actual_text == "A B\nC D"
+
+
+def test_optimal_wrap() -> None:
+    """Test the optimal wrap spreads the words evenly over the lines, where greedy fills the first lines."""
+    input_text = "- aaa bb cc ddddd, e."
+    greedy_text = format_rst(input_text, RstFormatterConfig(max_line_length=9))
+    assert greedy_text == "- aaa bb\n  cc\n  ddddd,\n  e."
+
+    config = RstFormatterConfig(max_line_length=9, wrap_algorithm="optimal")
+    actual_text = format_rst(input_text, config)
+    assert actual_text == "- aaa\n  bb cc\n  ddddd,\n  e."
+
+    # punctuation stays with the previous word, a word longer than the line gets its own line
+    actual_text = format_rst("*aaaa*, bb " + "c" * 20 + " dd", config)
+    assert actual_text == "*aaaa*,\nbb\n" + "c" * 20 + "\ndd"
 
 
 def test_ruff_filter() -> None:
@@ -338,6 +466,8 @@ def test_config_argparse() -> None:
 --titles # ^
 --newline-after-title 3
 --newline-bullet-list
+--keep-option-order
+--wrap=optimal
 --print-parse-tree
 """.split()
     )
@@ -347,22 +477,177 @@ def test_config_argparse() -> None:
         title_order=["#", "^"],
         newline_after_title=3,
         newline_bullet_list=True,
+        sort_directive_options=False,
+        wrap_algorithm="optimal",
         print_node_tree=True,
     )
     config = RstFormatterConfig.parse_argparse(args)
     assert config == expected
 
 
-def test_main() -> None:
+def test_main(tmp_path: Path) -> None:
     """Test if the main loop can be run."""
-    rst_file = tempfile.NamedTemporaryFile()
-    rst_file.write(b"something  or  other")
-    rst_file.flush()
-
-    assert main([rst_file.name, "--silent", "--diff", "--print-parse-tree"]) != 0
-    assert main([rst_file.name, "--diff"]) != 0
-    assert main([rst_file.name]) != 0
-    assert main([rst_file.name]) == 0
-    rst_file.seek(0)
-    out = rst_file.read()
-    assert out == b"something or other"
+    rst_file = tmp_path / "in.rst"
+    rst_file.write_bytes(b"something  or  other")
+
+    assert main([str(rst_file), "--silent", "--diff", "--print-parse-tree"]) != 0
+    assert main([str(rst_file), "--diff"]) != 0
+    assert main([str(rst_file)]) != 0
+    assert main([str(rst_file)]) == 0
+    assert rst_file.read_bytes() == b"something or other"
+
+
+def test_main_cache(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    """Test files that need no changes are remembered, and skipped the next time."""
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    rst_file = tmp_path / "file.rst"
+    rst_file.write_text("something  or  other")
+
+    assert main([str(rst_file), "--cache"]) != 0  # changed files are not cached
+    assert not formatted_cache_path().exists()
+    assert main([str(rst_file), "--cache"]) == 0
+    assert formatted_cache_path().exists()
+
+    formatted: list[str] = []
+
+    def recording_format_rst(content: str, _config: RstFormatterConfig) -> str:
+        formatted.append(content)
+        return content
+
+    monkeypatch.setattr(rst_formatter, "format_rst", recording_format_rst)
+    assert main([str(rst_file), "--cache"]) == 0
+    assert formatted == []
+    assert main([str(rst_file), "--cache", "--line-length=40"]) == 0  # different config, not in the cache
+    assert formatted == ["something or other"]
+    formatted_cache_path().write_text("not json")
+    assert main([str(rst_file), "--cache"]) == 0  # a broken cache is ignored
+    assert formatted == ["something or other"] * 2
+    for not_a_list in ("5", "null", "{}"):
+        formatted_cache_path().write_text(not_a_list)
+        assert main([str(rst_file), "--cache"]) == 0  # as is valid json that is not a list of hashes
+    assert formatted == ["something or other"] * 5
+
+    formatted_cache_path().unlink()
+    assert main([str(rst_file), "--cache", "--ruff"]) == 0  # the output of external filters is not in the hash
+    assert not formatted_cache_path().exists()
+
+
+def test_main_without_home(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    """Test the cache location, which needs a home directory, is only looked up when the cache is used."""
+
+    def no_home() -> Path:
+        raise RuntimeError("Could not determine home directory.")
+
+    monkeypatch.delenv("XDG_CACHE_HOME", raising=False)
+    monkeypatch.setattr(Path, "home", no_home)
+    rst_file = tmp_path / "file.rst"
+    rst_file.write_text("something  or  other")
+    assert main([str(rst_file), "--check"]) != 0
+
+
+def test_main_multiple_files(tmp_path: Path) -> None:
+    """Test multiple files can be formatted in parallel."""
+    rst_files = [tmp_path / f"file{idx}.rst" for idx in range(3)]
+    for rst_file in rst_files:
+        rst_file.write_text("something  or  other")
+    rst_files[1].write_text("something or other")
+    arguments = [str(rst_file) for rst_file in rst_files]
+
+    assert main([*arguments, "--jobs=2", "--check"]) != 0
+    assert main([*arguments, "--jobs=2", "--diff"]) != 0
+    assert main([*arguments, "--jobs=2"]) != 0
+    assert main([*arguments, "--jobs=2"]) == 0
+    assert all(rst_file.read_text() == "something or other" for rst_file in rst_files)
+
+
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_main_file_errors(tmp_path: Path, capsys: pytest.CaptureFixture[str], jobs: int) -> None:
+    """Test a file that cannot be formatted is reported, and the other files are still processed."""
+    rst_files = [tmp_path / f"file{idx}.rst" for idx in range(3)]
+    for rst_file in rst_files:
+        rst_file.write_text("something  or  other")
+    rst_files[1].write_text("1. enumerated lists are not supported")
+    missing_file = tmp_path / "missing.rst"
+
+    assert main([*map(str, rst_files), str(missing_file), f"--jobs={jobs}"]) != 0
+    lines = capsys.readouterr().out.splitlines()
+    assert lines[0] == f"{rst_files[0]}: Writing changes to '{rst_files[0]}'"
+    assert lines[1].startswith(f"{rst_files[1]}: error: ")
+    assert lines[2] == f"{rst_files[2]}: Writing changes to '{rst_files[2]}'"
+    assert lines[3].startswith(f"{missing_file}: error: ")
+    assert rst_files[2].read_text() == "something or other"
+
+
+def test_main_duplicate_files(tmp_path: Path, capsys: pytest.CaptureFixture[str]) -> None:
+    """Test a file given more than once is formatted once."""
+    rst_file = tmp_path / "file.rst"
+    rst_file.write_text("something  or  other")
+
+    assert main([str(rst_file), str(rst_file), "--jobs=2"]) != 0
+    assert capsys.readouterr().out == f"Writing changes to '{rst_file}'\n"
+    assert rst_file.read_text() == "something or other"
+
+
+class RecordingVisitor(nodes.NodeVisitor):
+    """Test-visitor that logs all visits and departures, and raises an exception at one of them."""
+
+    def __init__(self, document: nodes.document, raise_at: tuple[str, str], exception: type[Exception]) -> None:
+        """Construct RecordingVisitor."""
+        super().__init__(document)
+        self.log: list[tuple[str, str]] = []
+        self.raise_at = raise_at
+        self.exception = exception
+
+    def record(self, action: str, node: nodes.Node) -> None:
+        """Log the action, raise if this is the requested node."""
+        entry = (action, f"{node.tagname}:{node.astext()}")
+        self.log.append(entry)
+        if entry == self.raise_at:
+            raise self.exception
+
+    def unknown_visit(self, node: nodes.Node) -> None:
+        """Log a visit."""
+        self.record("visit", node)
+
+    def unknown_departure(self, node: nodes.Node) -> None:
+        """Log a departure."""
+        self.record("depart", node)
+
+
+@pytest.mark.parametrize(
+    ("raise_at", "exception"),
+    [
+        (("visit", "paragraph:a"), nodes.SkipNode),
+        (("visit", "paragraph:a"), nodes.SkipDeparture),
+        (("visit", "paragraph:a"), nodes.SkipChildren),
+        (("visit", "paragraph:a"), nodes.SkipSiblings),
+        (("visit", "paragraph:a"), nodes.StopTraversal),
+        (("visit", "section:t\n\na\n\nb"), nodes.SkipChildren),
+        (("visit", "section:t\n\na\n\nb"), nodes.StopTraversal),
+        (("depart", "paragraph:a"), nodes.SkipSiblings),
+        (("depart", "paragraph:a"), nodes.StopTraversal),
+        (("depart", "section:t\n\na\n\nb"), nodes.SkipSiblings),
+        (("visit", "document:t\n\na\n\nb\n\nc"), nodes.SkipSiblings),
+        (("depart", "document:t\n\na\n\nb\n\nc"), nodes.SkipSiblings),
+        (("depart", "document:t\n\na\n\nb\n\nc"), nodes.StopTraversal),
+    ],
+)
+def test_walkabout(raise_at: tuple[str, str], exception: type[Exception]) -> None:
+    """Test the non-recursive walkabout visits the nodes in the same order, and raises the same, as the docutils one."""
+    document = new_document("test")
+    section = nodes.section()
+    section += nodes.title("", "t")
+    section += nodes.paragraph("", "a")
+    section += nodes.paragraph("", "b")
+    document += section
+    document += nodes.paragraph("", "c")
+
+    def run(walk: Callable[[nodes.NodeVisitor], object]) -> tuple[list[tuple[str, str]], type | None]:
+        visitor = RecordingVisitor(document, raise_at, exception)
+        try:
+            walk(visitor)
+        except nodes.TreePruningException as err:
+            return visitor.log, type(err)
+        return visitor.log, None
+
+    assert run(partial(walkabout, document)) == run(document.walkabout)